@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016, Durachenko Aleksey V. <durachenko.aleksey@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, "src")
+
+
+def version():
+    return 'v0.1.0'
+
+
+def description():
+    return 'Benchmark of the qutimhistorymerge and qutimhistorysort on '   \
+           'the synthetic qutIM profile and of the mirandajson2contactjson ' \
+           'on the synthetic miranda json export. Exits with the non-zero ' \
+           'code if a case is slower or uses more memory than the baseline.'
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=description())
+    parser.add_argument('--version', action='version',
+                        version="%(prog)s " + version())
+    parser.add_argument('--accounts', action='store', type=int, default=2,
+                        help='the number of accounts (default: %(default)s)')
+    parser.add_argument('--contacts', action='store', type=int, default=20,
+                        help='the number of contacts per account '
+                             '(default: %(default)s)')
+    parser.add_argument('--months', action='store', type=int, default=12,
+                        help='the number of months per contact '
+                             '(default: %(default)s)')
+    parser.add_argument('--messages', action='store', type=int, default=500,
+                        help='the number of messages per month '
+                             '(default: %(default)s)')
+    parser.add_argument('--jobs', action='store', type=int, default=1,
+                        help='the --jobs passed to the tools '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', action='store', type=int, default=3,
+                        help='the number of runs of each case, the best '
+                             'run is reported (default: %(default)s)')
+    parser.add_argument('--baseline', action='store',
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), "baseline.json"),
+                        help='the baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--threshold', action='store', type=float,
+                        default=0.2,
+                        help='the allowed regression against the baseline '
+                             '(default: %(default)s)')
+    return parser.parse_args()
+
+
+def create_message(month, i, shift=0):
+    # the messages are two seconds apart, the shift moves them
+    # to the odd seconds
+    second = i * 2 + shift
+    return {
+        "in": i % 2 == 0,
+        "datetime": "2015-%02d-%02dT%02d:%02d:%02d" % (
+            month, second // 86400 % 28 + 1, second // 3600 % 24,
+            second // 60 % 60, second % 60),
+        "text": "the synthetic message number %d" % i
+    }
+
+
+def write_json_file(filename, data):
+    with open(filename, 'w', encoding='utf8') as outfile:
+        json.dump(data, outfile, sort_keys=True, indent=1, ensure_ascii=False)
+
+
+def create_profile(dst_dir, params, first=0, shift=0, reverse=False):
+    # returns the number of the written messages
+    count = 0
+    for account in range(params.accounts):
+        path = os.path.join(dst_dir, "history", "icq.%d" % (100000 + account))
+        os.makedirs(path, exist_ok=True)
+        for contact in range(params.contacts):
+            for month in range(1, params.months + 1):
+                messages = [create_message(month, i, shift)
+                            for i in range(first, first + params.messages)]
+                if reverse:
+                    messages.reverse()
+                filename = os.path.join(
+                    path, "%d.2015%02d.json" % (200000 + contact, month))
+                write_json_file(filename, messages)
+                count += len(messages)
+    return count
+
+
+def create_miranda_export(filename, params):
+    # returns the number of the events, every contact has the same number
+    # of the events as the month files of the qutIM profile; the events
+    # are written one by one to keep the peak RSS of the benchmark (and
+    # of the forked tools) low
+    per_contact = params.months * params.messages
+    count = params.accounts * params.contacts
+    contacts = [{
+        "id": number + 1,
+        "settings": {"icq": {"uin": 200000 + number}},
+        "first_event_id": number * per_contact + 1,
+        "first_unread_event_id": 0,
+        "last_event_id": (number + 1) * per_contact
+    } for number in range(count)]
+    with open(filename, 'w', encoding='utf8') as outfile:
+        outfile.write('{\n "accounts": {"icq": {"uin": 100000}},\n')
+        outfile.write(' "contacts": %s,\n "events": [' % json.dumps(contacts))
+        for number in range(count):
+            for i in range(per_contact):
+                event_id = number * per_contact + i + 1
+                if event_id > 1:
+                    outfile.write(',')
+                outfile.write('\n  ' + json.dumps({
+                    "id": event_id,
+                    "prev_id": event_id - 1 if i > 0 else 0,
+                    "next_id": event_id + 1 if i + 1 < per_contact else 0,
+                    "module_name": "ICQ",
+                    "timestamp": 1420070400 + i * 2,
+                    "incomming": i % 2 == 0,
+                    "text": "the synthetic \"message\" number %d {%d}" % (
+                        i, i),
+                    "flags": 0,
+                    "type": 0
+                }, ensure_ascii=False))
+        outfile.write('\n ]\n}\n')
+    return count * per_contact
+
+
+def run_tool(args):
+    # returns the wall time and the peak RSS (KiB) of the tool
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + args,
+                               stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    code = os.waitstatus_to_exitcode(status)
+    # the process is reaped by wait4(), Popen must not wait for it again
+    process.returncode = code
+    if code != 0:
+        raise RuntimeError("%s failed with the code %d" %
+                           (" ".join(args), code))
+    return elapsed, rusage.ru_maxrss
+
+
+def merge_args(src_dir, dst_dir, params):
+    return [os.path.join(SRC_DIR, "qutimhistorymerge.py"),
+            "--src", src_dir, "--dst", dst_dir, "--full",
+            "--fsync", "none", "--jobs", str(params.jobs)]
+
+
+def sort_args(src_dir, params):
+    return [os.path.join(SRC_DIR, "qutimhistorysort.py"),
+            "--src", src_dir, "--fsync", "none", "--jobs", str(params.jobs)]
+
+
+def contactjson_args(src_file, dst_file):
+    return [os.path.join(SRC_DIR, "mirandajson2contactjson.py"),
+            "--src", src_file, "--dst", dst_file]
+
+
+def create_cases(work_dir, params):
+    # returns the list of (name, templates, args, messages), the templates
+    # are copied to the run directory before every run of the case
+    half = params.messages // 2
+    src = os.path.join(work_dir, "src")
+    overlap = os.path.join(work_dir, "overlap")
+    disjoint = os.path.join(work_dir, "disjoint")
+    unsorted = os.path.join(work_dir, "unsorted")
+
+    src_count = create_profile(src, params)
+    overlap_count = create_profile(overlap, params, first=half)
+    disjoint_count = create_profile(disjoint, params, shift=1)
+    create_profile(unsorted, params, reverse=True)
+    export = os.path.join(work_dir, "export.json")
+    export_count = create_miranda_export(export, params)
+
+    run = os.path.join(work_dir, "run")
+    return [
+        ("merge_copy", {}, merge_args(src, run, params), src_count),
+        ("merge_overlapping", {run: overlap}, merge_args(src, run, params),
+         src_count + overlap_count),
+        ("merge_disjoint", {run: disjoint}, merge_args(src, run, params),
+         src_count + disjoint_count),
+        ("sort_sorted", {run: src}, sort_args(run, params), src_count),
+        ("sort_unsorted", {run: unsorted}, sort_args(run, params),
+         src_count),
+        ("miranda_contacts", {},
+         contactjson_args(export, os.path.join(work_dir, "contacts.json")),
+         export_count),
+    ]
+
+
+def run_case(work_dir, templates, args, repeat):
+    best = None
+    for _ in range(repeat):
+        run = os.path.join(work_dir, "run")
+        shutil.rmtree(run, ignore_errors=True)
+        for dst, template in templates.items():
+            shutil.copytree(template, dst)
+        elapsed, rss = run_tool(args)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, rss)
+    return best
+
+
+def get_params_key(params):
+    return {
+        "accounts": params.accounts,
+        "contacts": params.contacts,
+        "months": params.months,
+        "messages": params.messages,
+        "jobs": params.jobs
+    }
+
+
+def load_baseline(filename, params):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as data_file:
+        baseline = json.load(data_file)
+    if baseline.get("params") != get_params_key(params):
+        print("WARNING: the baseline was measured with other parameters")
+        return None
+    return baseline["cases"]
+
+
+def check_regression(result, baseline, threshold):
+    # returns the list of the regression descriptions
+    regressions = []
+    if result["messages_per_second"] < \
+            baseline["messages_per_second"] * (1.0 - threshold):
+        regressions.append("%.0f < %.0f msg/s" % (
+            result["messages_per_second"], baseline["messages_per_second"]))
+    if result["peak_rss_kb"] > baseline["peak_rss_kb"] * (1.0 + threshold):
+        regressions.append("%d > %d KiB" % (
+            result["peak_rss_kb"], baseline["peak_rss_kb"]))
+    return regressions
+
+
+def main():
+    parser = create_parser()
+
+    print("Summary:")
+    print("|  Accounts:", parser.accounts)
+    print("|  Contacts:", parser.contacts)
+    print("|    Months:", parser.months)
+    print("|  Messages:", parser.messages)
+    print("|      Jobs:", parser.jobs)
+    print("|  Baseline:", parser.baseline)
+
+    baseline = load_baseline(parser.baseline, parser)
+    results = {}
+    failed = False
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, templates, args, count in create_cases(work_dir, parser):
+            elapsed, rss = run_case(work_dir, templates, args, parser.repeat)
+            results[name] = {
+                "seconds": round(elapsed, 3),
+                "messages_per_second": round(count / elapsed),
+                "peak_rss_kb": rss
+            }
+            status = ""
+            if baseline is not None and name in baseline:
+                regressions = check_regression(results[name], baseline[name],
+                                               parser.threshold)
+                if regressions:
+                    failed = True
+                    status = "REGRESSION: " + ", ".join(regressions)
+                else:
+                    status = "OK"
+            print("%-18s %8.3f s %10d msg/s %8d KiB %s" % (
+                name, elapsed, results[name]["messages_per_second"],
+                rss, status))
+
+    if parser.save_baseline:
+        write_json_file(parser.baseline, {
+            "params": get_params_key(parser),
+            "cases": results
+        })
+        print("BASELINE SAVED:", parser.baseline)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,9 +16,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
-import json
 import datetime
 import argparse
+from qutimhistory import jid_escaped, save_qutim_history
 
 
 def version():
@@ -119,53 +119,14 @@ def get_contact_messages(src_dir, contact, account_type, verbose=False):
 def save_qutim_icq_history(dst_dir, uin, contact, messages, verbose=False):
     # format:
     #   history/icq.12345678/987654321.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "icq." + uin)
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, contact + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
-
-
-def jid_escaped(jid):
-    return jid.replace("@", "%0040").replace("_", "%005f").replace("-", "%002d")
+    save_qutim_history(dst_dir, "icq", uin, contact, messages)
 
 
 def save_qutim_jabber_history(dst_dir, jid, contact, messages, verbose=False):
     # format:
     #   history/jabber.user%0040jabber.org/user2%0040jabber.org.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "jabber." + jid_escaped(jid))
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, jid_escaped(contact) + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
+    save_qutim_history(dst_dir, "jabber", jid_escaped(jid),
+                       jid_escaped(contact), messages)
 
 
 def main():
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016, Durachenko Aleksey V. <durachenko.aleksey@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import re
+import json
+
+
+# the event fields used by the conversion, the other fields are dropped
+EVENT_FIELDS = ("id", "prev_id", "next_id", "module_name",
+                "timestamp", "incomming", "text")
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+SKIP_STRING = re.compile(STRING)
+# the complete strings and the other characters up to the next bracket
+RUN = r'[^"\[\]{}]*(?:' + STRING + r'[^"\[\]{}]*)*'
+# the array or the object without the nested arrays and objects
+FLAT = r'[\[{]' + RUN + r'[\]}]'
+SKIP_FLAT = re.compile(FLAT)
+# the runs and the flat arrays and objects up to the next bracket
+# that opens the nested one or closes the current one
+SKIP_RUN = re.compile(RUN + r'(?:' + FLAT + RUN + r')*')
+DELIMITER = re.compile(r'[,\]} \t\n\r]')
+
+
+class JsonStreamReader:
+    # The incremental reader of the JSON document. The file is read by
+    # chunks, the values are decoded one by one by raw_decode() and
+    # the unneeded values are skipped without building the objects.
+
+    def __init__(self, data_file, chunk_size=1024 * 1024):
+        self.data_file = data_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # drops the consumed part of the buffer and reads the next chunk,
+        # returns False at the end of the file
+        if self.eof:
+            return False
+        chunk = self.data_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def error(self, message):
+        return ValueError("%s near: %r" %
+                          (message, self.buffer[self.pos:self.pos + 40]))
+
+    def peek(self):
+        # skips the whitespaces and returns the next character,
+        # or the empty string at the end of the file
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self.error("'%s' expected" % char)
+        self.pos += 1
+
+    def read_value(self):
+        if self.peek() not in ('"', '[', '{'):
+            # the number or the literal is complete only if it is
+            # followed by the delimiter
+            while DELIMITER.search(self.buffer, self.pos) is None and \
+                    self.fill():
+                pass
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            self.pos = end
+            return value
+
+    def skip_string(self):
+        while True:
+            match = SKIP_STRING.match(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.end()
+                return
+            if not self.fill():
+                raise self.error("unterminated string")
+
+    def skip_value(self):
+        char = self.peek()
+        if char == '"':
+            self.skip_string()
+            return
+        if char not in ('[', '{'):
+            self.read_value()
+            return
+
+        # the strings, the runs between the brackets and the arrays and
+        # objects without the nested ones are skipped by the single regex
+        # match, only the other brackets are counted here
+        match = SKIP_FLAT.match(self.buffer, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            return
+        self.pos += 1
+        depth = 1
+        while True:
+            self.pos = SKIP_RUN.match(self.buffer, self.pos).end()
+            if self.pos == len(self.buffer) or self.buffer[self.pos] == '"':
+                # the end of the buffer or the string is not complete
+                if not self.fill():
+                    raise self.error("unexpected end of the document")
+                continue
+
+            char = self.buffer[self.pos]
+            self.pos += 1
+            if char in ('[', '{'):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def iter_object(self):
+        # yields the keys, the caller has to read or skip every value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise self.error("',' or '}' expected")
+
+    def iter_array(self):
+        # yields the decoded items
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise self.error("',' or ']' expected")
+
+
+def compact_event(event):
+    return {field: event.get(field) for field in EVENT_FIELDS}
+
+
+def read_miranda_json(filename):
+    # yields ("accounts", accounts), ("contacts", contact) and
+    # ("events", compact event) in the order of the file
+    with open(filename) as data_file:
+        reader = JsonStreamReader(data_file)
+        for key in reader.iter_object():
+            if key == "accounts":
+                yield key, reader.read_value()
+            elif key == "contacts":
+                for item in reader.iter_array():
+                    yield key, item
+            elif key == "events":
+                for item in reader.iter_array():
+                    yield key, compact_event(item)
+            else:
+                reader.skip_value()
+
+
+def read_miranda_contacts(filename):
+    # reads only the accounts and the contacts, the events
+    # are skipped without decoding
+    result = {}
+    with open(filename) as data_file:
+        reader = JsonStreamReader(data_file)
+        for key in reader.iter_object():
+            if key in ("accounts", "contacts"):
+                result[key] = reader.read_value()
+            else:
+                reader.skip_value()
+
+    return result
+
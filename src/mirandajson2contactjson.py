@@ -20,6 +20,7 @@ import json
 import datetime
 import argparse
 from unittest import result
+from mirandajson import read_miranda_contacts
 
 
 def version():
@@ -48,11 +49,6 @@ def save_json_file(filename, h):
     f.close()
 
 
-def load_json_file(filename):
-    with open(filename) as data_file:
-        return json.load(data_file)
-
-
 def main():
     parser = create_parser()
 
@@ -63,7 +59,7 @@ def main():
     print("|  Input Miranda Json File:", src_file)
     print("| Output Contact Json File:", dst_file)
 
-    in_data = load_json_file(src_file)
+    in_data = read_miranda_contacts(src_file)
     out_data = dict()
     out_data["accounts"] = in_data["accounts"]
     out_data["contacts"] = in_data["contacts"]
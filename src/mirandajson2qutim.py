@@ -17,9 +17,24 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import json
+import time
+import zlib
+import base64
+import array
+import heapq
+import bisect
 import datetime
 import argparse
+import contextlib
+import collections
 from unittest import result
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+from mirandajson import read_miranda_json
+from qutimhistory import jid_escaped, save_qutim_history
 
 
 def version():
@@ -51,6 +66,25 @@ def create_parser():
     parser.add_argument('--seq', action='store', required=True,
                         help='the first sequence number for unattached '
                              'message chains')
+    parser.add_argument('--keep-duplicates', action='store_true',
+                        help='do not remove the repeated events with the '
+                             'same time, direction and text')
+    parser.add_argument('--reattach', action='store_true',
+                        help='save the unattached message chain to the '
+                             'contact if it is the only contact of the same '
+                             'protocol whose history covers the chain')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the interrupted conversion from '
+                             'the last checkpoint')
+    parser.add_argument('--checkpoint-interval', action='store', type=float,
+                        default=60.0,
+                        help='the minimal number of seconds between the '
+                             'checkpoints (default: %(default)s)')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the time, the memory and the item '
+                             'counts of every conversion phase')
+    parser.add_argument('--stats-json', action='store', default=None,
+                        help='write the --stats report to the json file')
     return parser.parse_args()
 
 
@@ -81,237 +115,225 @@ def get_vk_contacts(json_data):
     return contacts
 
 
-def get_contact_ids(json_data):
-    ids = []
-    for item in json_data["contacts"]:
-        ids.append(item["id"])
-
-    return ids
-
-
-def get_event_ids(json_data):
-    ids = []
-    for item in json_data["events"]:
-        ids.append(item["id"])
-
-    return ids
-
-
-def get_events_by_id(json_data):
-    events = {}
-    for item in json_data["events"]:
-        events[item["id"]] = item
-
-    return events
-
-
-def get_icq_events(events):
-    result = []
-    for item in events:
-        if events[item]["module_name"] == "ICQ":
-            result.append(events[item])
-
-    return result
-
-
-def get_jabber_events(events):
-    result = []
-    for item in events:
-        if events[item]["module_name"] == "JABBER":
-            result.append(events[item])
-
-    return result
-
-
-def get_contact_events(contact, events):
-    result = []
-    result_ids = {}
-    id = contact["first_event_id"]
-    while True:
-        if id in events.keys():
-            x = events[id]
-            del events[id]
-            result.append(x)
-            result_ids[id] = 1
-            id = x["next_id"]
+class EventStore:
+    # The columnar storage of the Miranda events. The event is addressed
+    # by its position in the export, the texts are kept in the single
+    # utf-8 buffer. The events taken by the contacts and the chains are
+    # cleared in the present column instead of being deleted.
+
+    NONE = -1
+
+    def __init__(self):
+        self.ids = array.array('q')
+        self.prev_ids = array.array('q')
+        self.next_ids = array.array('q')
+        self.timestamps = array.array('q')
+        self.incoming = bytearray()
+        self.modules = array.array('H')
+        self.module_names = []
+        self.module_codes = {}
+        # the number of the present events of every module
+        self.module_counts = array.array('q')
+        self.text = bytearray()
+        self.text_offsets = array.array('Q', [0])
+        self.null_texts = set()
+        self.present = bytearray()
+        self.remaining = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.remaining
+
+    def to_id(self, value):
+        return self.NONE if value is None else value
+
+    def add(self, event):
+        module_name = event["module_name"]
+        if module_name not in self.module_codes:
+            self.module_codes[module_name] = len(self.module_names)
+            self.module_names.append(module_name)
+            self.module_counts.append(0)
+
+        if event["text"] is None:
+            self.null_texts.add(len(self.ids))
         else:
-            break
+            self.text += event["text"].encode('utf8', 'surrogatepass')
+        self.text_offsets.append(len(self.text))
+
+        self.ids.append(event["id"])
+        self.prev_ids.append(self.to_id(event["prev_id"]))
+        self.next_ids.append(self.to_id(event["next_id"]))
+        self.timestamps.append(event["timestamp"])
+        self.incoming.append(1 if event["incomming"] else 0)
+        self.modules.append(self.module_codes[module_name])
+        self.module_counts[self.module_codes[module_name]] += 1
+        self.present.append(1)
+        self.remaining += 1
+        self.tail += 1
+
+    def build_index(self):
+        # the positions sorted by id, prev_id and next_id, the lookups
+        # are binary searches over them; for the duplicated id only
+        # the first event is kept
+        self.by_id, self.sorted_ids = self.sort_column(self.ids)
+        self.by_prev, self.sorted_prev_ids = self.sort_column(self.prev_ids)
+        self.by_next, self.sorted_next_ids = self.sort_column(self.next_ids)
+        for i in range(1, len(self.sorted_ids)):
+            if self.sorted_ids[i] == self.sorted_ids[i - 1]:
+                self.take(self.by_id[i])
+
+    def sort_column(self, column):
+        order = array.array('q', sorted(range(len(column)),
+                                        key=column.__getitem__))
+        return order, array.array('q', (column[i] for i in order))
+
+    def find(self, id):
+        # returns the position of the present event, or None
+        if id is None:
+            return None
+        i = bisect.bisect_left(self.sorted_ids, id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == id:
+            position = self.by_id[i]
+            if self.present[position]:
+                return position
+        return None
 
-    id = contact["first_unread_event_id"]
-    while True:
-        if id in events.keys():
-            x = events[id]
-            del events[id]
-            result.append(x)
-            result_ids[id] = 1
-            id = x["next_id"]
-        else:
-            break
-
-    id = contact["last_event_id"]
-    while True:
-        if id in events.keys():
-            x = events[id]
-            del events[id]
-            result.append(x)
-            result_ids[id] = 1
-            id = x["prev_id"]
-        else:
-            break
+    def linked(self, id):
+        # yields the positions of the events with prev_id or next_id == id
+        for order, values in ((self.by_next, self.sorted_next_ids),
+                              (self.by_prev, self.sorted_prev_ids)):
+            i = bisect.bisect_left(values, id)
+            while i < len(values) and values[i] == id:
+                yield order[i]
+                i += 1
+
+    def prev_linked(self, id):
+        # yields the positions of the events with prev_id == id
+        i = bisect.bisect_left(self.sorted_prev_ids, id)
+        while i < len(self.sorted_prev_ids) and self.sorted_prev_ids[i] == id:
+            yield self.by_prev[i]
+            i += 1
+
+    def take(self, position):
+        self.present[position] = 0
+        self.remaining -= 1
+        self.module_counts[self.modules[position]] -= 1
+
+    def last(self):
+        # returns the position of the last present event, or None;
+        # the events are never returned back, so the search starts
+        # from the previous result
+        position = self.present.rfind(1, 0, self.tail)
+        self.tail = position + 1
+        return None if position < 0 else position
+
+    def module_name(self, position):
+        return self.module_names[self.modules[position]]
+
+    def get_text(self, position):
+        if position in self.null_texts:
+            return None
+        return self.text[self.text_offsets[position]:
+                         self.text_offsets[position + 1]].decode(
+            'utf8', 'surrogatepass')
+
+    def count_module(self, module_name):
+        code = self.module_codes.get(module_name)
+        if code is None:
+            return 0
+        return self.module_counts[code]
+
+    def get_module_counts(self):
+        return [(self.module_names[code], self.module_counts[code])
+                for code in range(len(self.module_names))]
+
+
+def count_lost_icq_events(store):
+    return store.count_module("ICQ")
+
+
+def count_lost_jabber_events(store):
+    return store.count_module("JABBER")
+
+
+class EventChain:
+    # Takes the events out of the store by the prev/next links. The
+    # events linked to the taken events are restored in the export order,
+    # like the full scan of the remaining events does.
+
+    def __init__(self, store):
+        self.store = store
+        self.result = []
+        self.candidates = []
+        self.current = -1
+
+    def add_candidates(self, positions):
+        for position in positions:
+            if self.store.present[position] and position > self.current:
+                heapq.heappush(self.candidates, position)
+
+    def append(self, position):
+        self.store.take(position)
+        self.result.append(position)
+        self.add_candidates(self.store.linked(self.store.ids[position]))
+
+    def take(self, id, links):
+        position = self.store.find(id)
+        while position is not None:
+            self.append(position)
+            position = self.store.find(links[position])
+
+    def restore(self):
+        while self.candidates:
+            self.current = heapq.heappop(self.candidates)
+            # already processed
+            if not self.store.present[self.current]:
+                continue
+            self.take(self.store.ids[self.current], self.store.next_ids)
+
+
+def get_contact_events(contact, store):
+    chain = EventChain(store)
+    chain.take(contact["first_event_id"], store.next_ids)
+    chain.take(contact["first_unread_event_id"], store.next_ids)
+    chain.take(contact["last_event_id"], store.prev_ids)
 
     # try to restore
-    for key in list(events.keys()):
-        # already processed
-        if key not in events.keys():
-            continue
+    chain.add_candidates(store.prev_linked(contact["id"]))
+    chain.restore()
 
-        if events[key]["prev_id"] == contact["id"]:
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["next_id"]
-                else:
-                    break
-        elif events[key]["next_id"] in result_ids.keys():
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["next_id"]
-                else:
-                    break
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["prev_id"]
-                else:
-                    break
-        elif events[key]["prev_id"] in result_ids.keys():
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["next_id"]
-                else:
-                    break
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["prev_id"]
-                else:
-                    break
-    return result
-
-
-def get_next_lost_chain(events):
-    if not events:
-        return None
+    return chain.result
 
-    result = []
-    result_ids = {}
-
-    main_key, main_value = events.popitem()
-    result.append(main_value)
-    result_ids[main_key] = 1
-
-    id = main_value["next_id"]
-    while True:
-        if id in events.keys():
-            x = events[id]
-            del events[id]
-            result.append(x)
-            result_ids[id] = 1
-            id = x["next_id"]
-        else:
-            break
 
-    id = main_value["prev_id"]
-    while True:
-        if id in events.keys():
-            x = events[id]
-            del events[id]
-            result.append(x)
-            result_ids[id] = 1
-            id = x["prev_id"]
-        else:
-            break
+def get_lost_chains(store):
+    # yields the unattached chains, the chain starts from
+    # the last remaining event
+    while len(store):
+        chain = EventChain(store)
+        main = store.last()
+        chain.append(main)
+        chain.take(store.next_ids[main], store.next_ids)
+        chain.take(store.prev_ids[main], store.prev_ids)
+        chain.restore()
+        yield chain.result
 
-    # try to restore
-    for key in list(events.keys()):
-        # already processed
-        if key not in events.keys():
-            continue
 
-        if events[key]["next_id"] in result_ids.keys():
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["next_id"]
-                else:
-                    break
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["prev_id"]
-                else:
-                    break
-        elif events[key]["prev_id"] in result_ids.keys():
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["next_id"]
-                else:
-                    break
-            id = key
-            while True:
-                if id in events.keys():
-                    x = events[id]
-                    del events[id]
-                    result.append(x)
-                    result_ids[id] = 1
-                    id = x["prev_id"]
-                else:
-                    break
-    return result
-
-
-def event_list_to_messages(event_list, verbose=False):
+def event_list_to_messages(store, event_list, verbose=False, dedupe=True):
+    # the repeated events (the same time, direction and text under
+    # the different ids) are converted once
     objects = []
-    for event in event_list:
+    keys = set()
+    for position in event_list:
+        if dedupe:
+            key = (store.timestamps[position], store.incoming[position],
+                   store.get_text(position))
+            if key in keys:
+                continue
+            keys.add(key)
         objects.append({
-            "in": event["incomming"],
-            "datetime": datetime.datetime.fromtimestamp(event["timestamp"]).strftime('%Y-%m-%dT%H:%M:%S'),
-            "text": event["text"]
+            "in": store.incoming[position] == 1,
+            "datetime": datetime.datetime.fromtimestamp(store.timestamps[position]).strftime('%Y-%m-%dT%H:%M:%S'),
+            "text": store.get_text(position)
         })
 
     objects.sort(key=lambda x: x['datetime'])
@@ -319,109 +341,276 @@ def event_list_to_messages(event_list, verbose=False):
     return objects
 
 
-def jid_escaped(jid):
-    return jid.replace("@", "%0040").replace("_", "%005f").replace("-", "%002d")
-
-
-def save_qutim_other_history(dst_dir, userid, contact, messages, verbose=False):
+def save_qutim_other_history(dst_dir, userid, contact, messages, verbose=False,
+                             append=False):
     # format:
     #   history/other.useremail/987654321.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "other." + jid_escaped(userid))
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, contact + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
+    save_qutim_history(dst_dir, "other", jid_escaped(userid), contact,
+                       messages, append)
 
 
-def save_qutim_vk_history(dst_dir, userid, contact, messages, verbose=False):
+def save_qutim_vk_history(dst_dir, userid, contact, messages, verbose=False,
+                          append=False):
     # format:
     #   history/vk.useremail/987654321.201409.json
-    if messages is None:
-        return
+    save_qutim_history(dst_dir, "vk", jid_escaped(userid), contact, messages,
+                       append)
 
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
 
-    path = os.path.join(dst_dir, "history", "vk." + jid_escaped(userid))
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, contact + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
-
-
-def save_qutim_icq_history(dst_dir, uin, contact, messages, verbose=False):
+def save_qutim_icq_history(dst_dir, uin, contact, messages, verbose=False,
+                           append=False):
     # format:
     #   history/icq.12345678/987654321.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
+    save_qutim_history(dst_dir, "icq", uin, contact, messages, append)
 
-    path = os.path.join(dst_dir, "history", "icq." + uin)
-    os.makedirs(path, exist_ok=True)
 
-    for key in ym_hash:
-        filename = os.path.join(path, contact + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
-
-
-def save_qutim_jabber_history(dst_dir, jid, contact, messages, verbose=False):
+def save_qutim_jabber_history(dst_dir, jid, contact, messages, verbose=False,
+                              append=False):
     # format:
     #   history/jabber.user%0040jabber.org/user2%0040jabber.org.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "jabber." + jid_escaped(jid))
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, jid_escaped(contact) + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
-
-
-def load_json_file(filename):
-    with open(filename) as data_file:
-        return json.load(data_file)
+    save_qutim_history(dst_dir, "jabber", jid_escaped(jid),
+                       jid_escaped(contact), messages, append)
+
+
+def get_event_range(store, event_list):
+    timestamps = [store.timestamps[position] for position in event_list]
+    return min(timestamps), max(timestamps)
+
+
+class IntervalIndex:
+    # The intervals sorted by the start with the tree of the maximal ends
+    # above them. The intervals which contain [first, last] start not later
+    # than the first, that is the prefix of the sorted intervals, and end not
+    # earlier than the last, so only the subtrees with the maximal end
+    # >= last are visited.
+
+    def __init__(self, intervals):
+        # intervals: the list of (start, end, value)
+        intervals = sorted(intervals, key=lambda x: x[0])
+        self.starts = [x[0] for x in intervals]
+        self.values = [x[2] for x in intervals]
+        self.size = 1
+        while self.size < len(intervals):
+            self.size *= 2
+        self.max_ends = [None] * (2 * self.size)
+        for i, interval in enumerate(intervals):
+            self.max_ends[self.size + i] = interval[1]
+        for node in range(self.size - 1, 0, -1):
+            ends = [x for x in self.max_ends[2 * node:2 * node + 2]
+                    if x is not None]
+            self.max_ends[node] = max(ends) if ends else None
+
+    def find(self, first, last, limit=None):
+        # returns the values of the intervals containing [first, last],
+        # no more than limit of them
+        result = []
+        count = bisect.bisect_right(self.starts, first)
+        self.collect(1, 0, self.size, count, last, limit, result)
+        return result
+
+    def collect(self, node, low, high, count, last, limit, result):
+        if low >= count or self.max_ends[node] is None or \
+                self.max_ends[node] < last or \
+                (limit is not None and len(result) >= limit):
+            return
+        if high - low == 1:
+            result.append(self.values[low])
+            return
+        middle = (low + high) // 2
+        self.collect(2 * node, low, middle, count, last, limit, result)
+        self.collect(2 * node + 1, middle, high, count, last, limit, result)
+
+
+CONTACT_SAVERS = {
+    "vk": save_qutim_vk_history,
+    "icq": save_qutim_icq_history,
+    "jabber": save_qutim_jabber_history
+}
+
+
+def create_contact_index(contact_ranges):
+    # contact_ranges: the list of
+    #   [module name, first timestamp, last timestamp,
+    #    protocol, account, contact]
+    intervals = {}
+    for module_name, first, last, protocol, account, contact in contact_ranges:
+        intervals.setdefault(module_name, []).append(
+            (first, last, (protocol, account, contact)))
+    return {module_name: IntervalIndex(items)
+            for module_name, items in intervals.items()}
+
+
+def find_chain_contact(contact_index, store, chain):
+    # returns (protocol, account, contact) if the chain fits the history
+    # of exactly one contact, otherwise None
+    index = contact_index.get(store.module_name(chain[0]))
+    if index is None:
+        return None
+    first, last = get_event_range(store, chain)
+    candidates = index.find(first, last, limit=2)
+    if len(candidates) != 1:
+        return None
+    return candidates[0]
+
+
+class Stats:
+    # The wall time, the CPU time and the item counts of the conversion
+    # phases. The phase may be entered many times, the times and the counts
+    # are accumulated. The peak RSS is the high-water mark of the whole
+    # process at the end of the phase, not the memory used by the phase.
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def get_phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {
+                "wall_seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "process_peak_rss_kb": None,
+                "count": 0
+            }
+        return self.phases[name]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            item = self.get_phase(name)
+            item["wall_seconds"] += time.perf_counter() - wall
+            item["cpu_seconds"] += time.process_time() - cpu
+            if resource is not None:
+                item["process_peak_rss_kb"] = \
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def add(self, name, count):
+        if self.enabled:
+            self.get_phase(name)["count"] += count
+
+    def count(self, name, count):
+        # the counter which does not belong to a phase
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def print_table(self):
+        print("Stats:")
+        print("| %-12s | %10s | %10s | %18s | %10s |" %
+              ("phase", "wall, s", "cpu, s", "process peak, KiB", "count"))
+        for name, item in self.phases.items():
+            rss = item["process_peak_rss_kb"]
+            print("| %-12s | %10.3f | %10.3f | %18s | %10d |" % (
+                name, item["wall_seconds"], item["cpu_seconds"],
+                "-" if rss is None else rss, item["count"]))
+        for name, count in self.counters.items():
+            print("| %-12s | %10d |" % (name, count))
+
+    def write_json(self, filename):
+        with open(filename, 'w', encoding='utf8') as outfile:
+            json.dump({"phases": self.phases, "counters": self.counters},
+                      outfile, indent=1)
+
+
+class Checkpoint:
+    # The progress of the conversion, saved next to the output directory:
+    #   output.checkpoint.json
+    # It keeps the finished contacts and their time ranges, the next sequence
+    # number of the lost chains and the present column of the store, so
+    # the resumed run takes the same events as the interrupted one.
+    # The unfinished contact is converted again, its month files are
+    # overwritten.
+
+    def __init__(self, dst_dir, json_file, first_seq_number, interval):
+        self.filename = os.path.normpath(dst_dir) + ".checkpoint.json"
+        stat = os.stat(json_file)
+        self.source = {
+            "json": os.path.abspath(json_file),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "seq": int(first_seq_number)
+        }
+        self.interval = interval
+        self.done = set()
+        self.ranges = []
+        self.seq = int(first_seq_number)
+        self.present = None
+        self.saved = time.monotonic()
+
+    def load(self):
+        # returns False if there is no checkpoint
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, encoding='utf8') as data_file:
+            data = json.load(data_file)
+        if data["source"] != self.source:
+            raise ValueError("the checkpoint %s was made for another input "
+                             "or sequence number" % self.filename)
+        self.done = set(data["done"])
+        self.ranges = data["ranges"]
+        self.seq = data["seq"]
+        self.present = zlib.decompress(base64.b64decode(data["present"]))
+        return True
+
+    def restore(self, store):
+        # takes the events which were taken before the checkpoint
+        if len(self.present) != len(store.present):
+            raise ValueError("the checkpoint %s does not match the number "
+                             "of the events" % self.filename)
+        position = self.present.find(0)
+        while position >= 0:
+            if store.present[position]:
+                store.take(position)
+            position = self.present.find(0, position + 1)
+
+    def is_done(self, step):
+        return step in self.done
+
+    def finish(self, store, step=None, seq=None):
+        # the step is finished when its files are written
+        if step is not None:
+            self.done.add(step)
+        if seq is not None:
+            self.seq = seq
+        if time.monotonic() - self.saved >= self.interval:
+            self.save(store)
+
+    def save(self, store):
+        data = {
+            "source": self.source,
+            "done": sorted(self.done),
+            "ranges": self.ranges,
+            "seq": self.seq,
+            "present": base64.b64encode(
+                zlib.compress(bytes(store.present))).decode('ascii')
+        }
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf8') as outfile:
+            json.dump(data, outfile)
+        os.replace(tmp_filename, self.filename)
+        self.saved = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def save_events(stats, store, event_list, save, dst_dir, account, contact,
+                verbose=False, append=False, dedupe=True):
+    with stats.phase("format"):
+        messages = event_list_to_messages(store, event_list, verbose, dedupe)
+    stats.add("format", len(messages))
+    stats.count("duplicates", len(event_list) - len(messages))
+
+    with stats.phase("write"):
+        save(dst_dir, account, contact, messages, verbose, append)
+    stats.add("write", len(messages))
 
 
 def main():
@@ -431,8 +620,34 @@ def main():
     dst_dir = parser.dst
     first_seq_number = parser.seq
     verbose = parser.verbose
+    stats = Stats(parser.stats or parser.stats_json is not None)
+    dedupe = not parser.keep_duplicates
+
+    json_data = {"accounts": {}, "contacts": []}
+    store = EventStore()
+    with stats.phase("load"):
+        for key, value in read_miranda_json(json_file):
+            if key == "accounts":
+                json_data[key] = value
+            elif key == "contacts":
+                json_data[key].append(value)
+            else:
+                store.add(value)
+    stats.add("load", len(store))
+
+    with stats.phase("index"):
+        store.build_index()
+
+    checkpoint = Checkpoint(dst_dir, json_file, first_seq_number,
+                            parser.checkpoint_interval)
+    resumed = parser.resume and checkpoint.load()
+    if resumed:
+        checkpoint.restore(store)
+    else:
+        # the checkpoint of the interrupted run is stale now, a later
+        # --resume must not skip the steps of this run
+        checkpoint.remove()
 
-    json_data = load_json_file(json_file)
     try:
         uin = json_data["accounts"]["icq"]["uin"]
     except:
@@ -453,91 +668,132 @@ def main():
     print("|                      JID:", jid)
     print("|                       VK:", vkid)
     print("|         First Seq Number:", first_seq_number)
-
-    contact_ids = get_contact_ids(json_data)
-    event_ids = get_event_ids(json_data)
-    events = get_events_by_id(json_data)
+    print("|               Checkpoint:", checkpoint.filename)
+    print("|                  Resumed:", resumed)
 
     if vkid is not None:
-        for contact in get_vk_contacts(json_data):
+        for index, contact in enumerate(get_vk_contacts(json_data)):
             contact_vkid = contact["settings"]["vk"]["id"]
-            contact_events = get_contact_events(contact, events)
+            step = "vk:%d:%s" % (index, contact_vkid)
+            if checkpoint.is_done(step):
+                print("VK:", contact_vkid, "DONE")
+                continue
+            with stats.phase("contacts"):
+                contact_events = get_contact_events(contact, store)
+            stats.add("contacts", len(contact_events))
             print("VK:", contact_vkid, "COUNT:", len(contact_events))
-            save_qutim_vk_history(
-                    dst_dir,
-                    str(vkid),
-                    str(contact_vkid),
-                    event_list_to_messages(contact_events, verbose),
-                    verbose)
-        print("ICQ LOST:", len(get_icq_events(events)))
+            save_events(
+                stats, store, contact_events, save_qutim_vk_history,
+                dst_dir, str(vkid), str(contact_vkid), verbose, dedupe=dedupe)
+            if contact_events:
+                first, last = get_event_range(store, contact_events)
+                checkpoint.ranges.append(["VKontakte", first, last, "vk",
+                                          str(vkid), str(contact_vkid)])
+            checkpoint.finish(store, step)
+        print("ICQ LOST:", count_lost_icq_events(store))
 
     if uin is not None:
-        for contact in get_icq_contacts(json_data):
+        for index, contact in enumerate(get_icq_contacts(json_data)):
             contact_uin = contact["settings"]["icq"]["uin"]
-            contact_events = get_contact_events(contact, events)
+            step = "icq:%d:%s" % (index, contact_uin)
+            if checkpoint.is_done(step):
+                print("ICQ:", contact_uin, "DONE")
+                continue
+            with stats.phase("contacts"):
+                contact_events = get_contact_events(contact, store)
+            stats.add("contacts", len(contact_events))
             print("ICQ:", contact_uin, "COUNT:", len(contact_events))
-            save_qutim_icq_history(
-                    dst_dir,
-                    str(uin),
-                    str(contact_uin),
-                    event_list_to_messages(contact_events, verbose),
-                    verbose)
-        print("ICQ LOST:", len(get_icq_events(events)))
+            save_events(
+                stats, store, contact_events, save_qutim_icq_history,
+                dst_dir, str(uin), str(contact_uin), verbose, dedupe=dedupe)
+            if contact_events:
+                first, last = get_event_range(store, contact_events)
+                checkpoint.ranges.append(["ICQ", first, last, "icq",
+                                          str(uin), str(contact_uin)])
+            checkpoint.finish(store, step)
+        print("ICQ LOST:", count_lost_icq_events(store))
 
     if jid is not None:
-        for contact in get_jabber_contacts(json_data):
+        for index, contact in enumerate(get_jabber_contacts(json_data)):
             contact_jid = contact["settings"]["jabber"]["jid"]
-            contact_events = get_contact_events(contact, events)
+            step = "jabber:%d:%s" % (index, contact_jid)
+            if checkpoint.is_done(step):
+                print("JABBER:", contact_jid, "DONE")
+                continue
+            with stats.phase("contacts"):
+                contact_events = get_contact_events(contact, store)
+            stats.add("contacts", len(contact_events))
             print("JABBER:", contact_jid, "COUNT:", len(contact_events))
-            save_qutim_jabber_history(
-                    dst_dir,
-                    str(jid),
-                    str(contact_jid),
-                    event_list_to_messages(contact_events, verbose),
-                    verbose)
-        print("JABBER LOST:", len(get_jabber_events(events)))
-
-    print("TOTAL LOST:", len(events))
+            save_events(
+                stats, store, contact_events, save_qutim_jabber_history,
+                dst_dir, str(jid), str(contact_jid), verbose, dedupe=dedupe)
+            if contact_events:
+                first, last = get_event_range(store, contact_events)
+                checkpoint.ranges.append(["JABBER", first, last, "jabber",
+                                          str(jid), str(contact_jid)])
+            checkpoint.finish(store, step)
+        print("JABBER LOST:", count_lost_jabber_events(store))
+
+    print("TOTAL LOST:", len(store))
+    if verbose:
+        for module_name, count in store.get_module_counts():
+            print("MODULE LOST:", module_name, "COUNT:", count)
 
     # extract unattached chains
-    seq = int(first_seq_number)
+    seq = checkpoint.seq
+    if parser.reattach:
+        contact_index = create_contact_index(checkpoint.ranges)
+    chains = get_lost_chains(store)
     while True:
-        chain = get_next_lost_chain(events)
+        with stats.phase("lost chains"):
+            chain = next(chains, None)
         if chain is None:
             break
-        print("LOST CHAIN", seq, "(", chain[0]["module_name"], ")", ":", len(chain))
-        if chain[0]["module_name"] == "IRC":
+        stats.add("lost chains", 1)
+
+        module_name = store.module_name(chain[0])
+        print("LOST CHAIN", seq, "(", module_name, ")", ":", len(chain))
+        if module_name == "IRC":
+            checkpoint.finish(store)
             continue
-        elif chain[0]["module_name"] == "ICQ":
-            save_qutim_icq_history(
-                    dst_dir,
-                    str("unknow"),
-                    str(seq),
-                    event_list_to_messages(chain, verbose),
-                    verbose)
-        elif chain[0]["module_name"] == "JABBER":
-            save_qutim_jabber_history(
-                    dst_dir,
-                    str("unknow"),
-                    str(seq),
-                    event_list_to_messages(chain, verbose),
-                    verbose)
-        elif chain[0]["module_name"] == "VKontakte":
-            save_qutim_jabber_history(
-                    dst_dir,
-                    str("unknow"),
-                    str(seq),
-                    event_list_to_messages(chain, verbose),
-                    verbose)
+
+        if parser.reattach:
+            with stats.phase("reattach"):
+                target = find_chain_contact(contact_index, store, chain)
+            if target is not None:
+                protocol, account, contact = target
+                stats.add("reattach", 1)
+                print("REATTACHED:", protocol.upper(), contact)
+                save_events(
+                    stats, store, chain, CONTACT_SAVERS[protocol],
+                    dst_dir, account, contact, verbose,
+                    append=True, dedupe=dedupe)
+                checkpoint.finish(store)
+                continue
+
+        if module_name == "ICQ":
+            save = save_qutim_icq_history
+        elif module_name == "JABBER":
+            save = save_qutim_jabber_history
+        elif module_name == "VKontakte":
+            save = save_qutim_jabber_history
         else:
-            save_qutim_other_history(
-                    dst_dir,
-                    str("unknow"),
-                    str(seq),
-                    event_list_to_messages(chain, verbose),
-                    verbose)
+            save = save_qutim_other_history
+        save_events(
+            stats, store, chain, save,
+            dst_dir, str("unknow"), str(seq), verbose, dedupe=dedupe)
 
         seq += 1
+        checkpoint.finish(store, seq=seq)
+
+    # the conversion is complete
+    checkpoint.remove()
+    print("DUPLICATES REMOVED:", stats.counters.get("duplicates", 0))
+
+    if stats.enabled:
+        stats.print_table()
+    if parser.stats_json is not None:
+        stats.write_json(parser.stats_json)
 
 
 if __name__ == "__main__":
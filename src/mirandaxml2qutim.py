@@ -16,10 +16,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
-import json
 import re
 from xml.dom import minidom
 import argparse
+from qutimhistory import child_nodes_to_text, save_qutim_history
 
 
 def version():
@@ -72,58 +72,33 @@ def create_message_object(msg_is_incoming, msg_date, msg_time, msg_text):
     }
 
 
-def node_to_text(node, name):
-    if len(node.getElementsByTagName(name)) == 0:
-        return None
-    x = node.getElementsByTagName(name)[0].firstChild
-    if x is None:
-        return None
-    return x.nodeValue
+EVENT_FIELDS = ("DATE", "TIME", "ID", "TYPE", "MESSAGE")
 
 
 def file_to_messages(filename, uin, verbose=False):
-    objects = []
+    # yields the messages in the order of the file
     xmldoc = minidom.parse(filename)
     for imhistory in xmldoc.getElementsByTagName('IMHISTORY'):
         for event in imhistory.getElementsByTagName('EVENT'):
-            date = node_to_text(event, "DATE")
-            time = node_to_text(event, "TIME")
-            id = node_to_text(event, "ID")
-            type = node_to_text(event, "TYPE")
-            msg = node_to_text(event, "MESSAGE")
+            fields = child_nodes_to_text(event, EVENT_FIELDS)
+            date = fields["DATE"]
+            time = fields["TIME"]
+            id = fields["ID"]
+            type = fields["TYPE"]
+            msg = fields["MESSAGE"]
 
             if date is None or time is None or id is None or msg is None:
                 if verbose:
                     print("SKIP:", date, time, id, type, msg)
                 continue
 
-            objects.append(create_message_object(id != uin, date, time, msg))
-
-    return objects
+            yield create_message_object(id != uin, date, time, msg)
 
 
 def save_qutim_icq_history(dst_dir, uin, contact, messages, verbose=False):
     # format:
     #   history/icq.12345678/987654321.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "icq." + uin)
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, contact + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
+    save_qutim_history(dst_dir, "icq", uin, contact, messages)
 
 
 def main():
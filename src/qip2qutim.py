@@ -16,10 +16,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
-import json
 import re
 import datetime
 import argparse
+from qutimhistory import save_qutim_history
 
 
 def version():
@@ -83,28 +83,27 @@ def create_message_object(message_incoming, message_header, message_lines):
 
 
 def file_to_messages(filename, verbose=False):
-    objects = []
-
+    # yields the messages as they are read
     message_header = ""
     message_lines = []
     message_incoming = False
 
-    for line in open(filename, 'r').readlines():
+    for line in open(filename, 'r'):
         line = line.rstrip()
         if line == "--------------------------------------<-":
             if message_header != "" and len(message_lines) > 0:
-                objects.append(create_message_object(message_incoming,
-                                                     message_header,
-                                                     message_lines))
+                yield create_message_object(message_incoming,
+                                            message_header,
+                                            message_lines)
             message_incoming = True
             message_header = ""
             message_lines = []
             continue
         if line == "-------------------------------------->-":
             if message_header != "" and len(message_lines) > 0:
-                objects.append(create_message_object(message_incoming,
-                                                     message_header,
-                                                     message_lines))
+                yield create_message_object(message_incoming,
+                                            message_header,
+                                            message_lines)
             message_incoming = False
             message_header = ""
             message_lines = []
@@ -117,35 +116,15 @@ def file_to_messages(filename, verbose=False):
         message_lines.append(line)
 
     if message_header != "" and len(message_lines) > 0:
-        objects.append(create_message_object(message_incoming,
-                                             message_header,
-                                             message_lines))
-
-    return objects
+        yield create_message_object(message_incoming,
+                                    message_header,
+                                    message_lines)
 
 
 def save_qutim_icq_history(dst_dir, uin, contact, messages, verbose=False):
     # format:
     #   history/icq.12345678/987654321.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "icq." + uin)
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, contact + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
+    save_qutim_history(dst_dir, "icq", uin, contact, messages)
 
 
 def main():
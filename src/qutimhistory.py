@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016, Durachenko Aleksey V. <durachenko.aleksey@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+import time
+import datetime
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+
+def jid_escaped(jid):
+    return jid.replace("@", "%0040").replace("_", "%005f").replace("-", "%002d")
+
+
+def month_key(message):
+    return message['datetime'][0:4] + message['datetime'][5:7]
+
+
+def message_key(message):
+    return message['datetime'], message['in'], message['text']
+
+
+def load_json_file(filename):
+    with open(filename, encoding='utf8') as data_file:
+        return json.load(data_file)
+
+
+def dump_json(data):
+    return json.dumps(data, sort_keys=True, indent=1, ensure_ascii=False)
+
+
+def is_same_file_content(filename, content):
+    try:
+        if os.path.getsize(filename) != len(content):
+            return False
+        with open(filename, 'rb') as data_file:
+            return data_file.read() == content
+    except FileNotFoundError:
+        return False
+
+
+def fsync_dir(dir):
+    fd = os.open(dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_file(filename, data, fsync='file'):
+    # the file is replaced atomically, fsync: none, file (the file data)
+    # or full (the file data and the directory entry);
+    # returns False if the file already has the same content
+    content = dump_json(data).encode('utf8')
+    if is_same_file_content(filename, content):
+        return False
+
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as outfile:
+        outfile.write(content)
+        if fsync != 'none':
+            outfile.flush()
+            os.fsync(outfile.fileno())
+    os.replace(tmp_filename, filename)
+    if fsync == 'full':
+        fsync_dir(os.path.dirname(os.path.abspath(filename)))
+    return True
+
+
+# the account directories are named as "protocol.account"
+ACCOUNT_PROTOCOLS = ("icq", "jabber", "skype", "vk", "sms", "other")
+
+
+def get_account_protocol(name):
+    protocol = name.split(".", 1)[0]
+    if protocol in ACCOUNT_PROTOCOLS:
+        return protocol
+    return None
+
+
+def get_accounts(history_dir):
+    accounts = []
+    with os.scandir(history_dir) as entries:
+        for entry in entries:
+            protocol = get_account_protocol(entry.name)
+            if protocol is not None and entry.is_dir():
+                accounts.append((ACCOUNT_PROTOCOLS.index(protocol),
+                                 entry.name))
+    return [name for _, name in sorted(accounts)]
+
+
+def get_json_files(dir):
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".json"):
+                yield entry.name
+
+
+def measure_throughput(count=10000):
+    # the bytes per second of the decoding, sorting and encoding
+    # of the synthetic month file
+    messages = [{
+        "in": i % 2 == 0,
+        "datetime": "2016-01-%02dT%02d:%02d:%02d" % (
+            i // 86400 % 28 + 1, i // 3600 % 24, i // 60 % 60, i % 60),
+        "text": "message %d" % i
+    } for i in reversed(range(count))]
+    text = dump_json(messages)
+
+    start = time.perf_counter()
+    data = json.loads(text)
+    data.sort(key=lambda x: x['datetime'])
+    dump_json(data)
+    elapsed = time.perf_counter() - start
+
+    return len(text.encode('utf8')) / max(elapsed, 1e-6)
+
+
+def print_plan(plan, jobs):
+    total_files = sum(files for files, _ in plan.values())
+    total_bytes = sum(size for _, size in plan.values())
+    throughput = measure_throughput()
+    estimated = total_bytes / throughput / max(1, min(jobs, total_files))
+
+    print("Plan:")
+    for action, (files, size) in plan.items():
+        print("| %9s: %d files, %d bytes" % (action, files, size))
+    print("| %9s: %d files, %d bytes" % ("TOTAL", total_files, total_bytes))
+    print("| Throughput: %.1f MB/s per job" % (throughput / 1024 / 1024))
+    print("|  Estimated:",
+          datetime.timedelta(seconds=int(round(estimated))))
+
+
+def run_tasks(tasks, jobs):
+    # tasks: the (func, args) pairs; the functions are run in the process
+    # pool with no more than 2 * jobs tasks in flight, the results are
+    # returned in the order of the tasks
+    if jobs <= 1:
+        for func, args in tasks:
+            yield func(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for func, args in tasks:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def child_nodes_to_text(node, names):
+    # returns {name: text} of the first direct child element with every
+    # name, the missing elements are None; the children are walked once
+    # instead of the subtree search for every name
+    result = dict.fromkeys(names)
+    found = set()
+    for child in node.childNodes:
+        if child.nodeType != child.ELEMENT_NODE:
+            continue
+        name = child.tagName
+        if name not in result or name in found:
+            continue
+        found.add(name)
+        if child.firstChild is not None:
+            result[name] = child.firstChild.nodeValue
+    return result
+
+
+class HistoryWriter:
+    # Routes the messages of the contact to the month files:
+    #   history/protocol.account/contact.201409.json
+    # The months older than the newest received message are written
+    # immediately, so for the time-ordered messages only one month
+    # is kept in the memory. The messages are written in the order they
+    # are added; if a message of the already written month arrives later,
+    # it is appended to the month file on the next write.
+    # In the append mode the month files written by the previous writers
+    # are merged too: the messages which are already there are skipped
+    # and the merged month is sorted by the datetime.
+
+    def __init__(self, dst_dir, protocol, account, contact, append=False):
+        self.path = os.path.join(dst_dir, "history", protocol + "." + account)
+        self.contact = contact
+        self.append = append
+        self.months = {}
+        self.written = set()
+        self.newest = None
+
+    def filename(self, key):
+        return os.path.join(self.path, self.contact + "." + key + ".json")
+
+    def add(self, message):
+        key = month_key(message)
+        if self.newest is None or key > self.newest:
+            self.newest = key
+            self.flush(lambda x: x < key)
+
+        if key not in self.months:
+            self.months[key] = []
+        self.months[key].append(message)
+
+    def flush(self, predicate=lambda x: True):
+        for key in sorted(x for x in self.months if predicate(x)):
+            messages = self.months.pop(key)
+            filename = self.filename(key)
+            if key in self.written:
+                messages = load_json_file(filename) + messages
+            elif self.append and os.path.exists(filename):
+                existing = load_json_file(filename)
+                keys = set(message_key(x) for x in existing)
+                messages = existing + [x for x in messages
+                                       if message_key(x) not in keys]
+                messages.sort(key=lambda x: x['datetime'])
+
+            os.makedirs(self.path, exist_ok=True)
+            # the converters write into the new directory,
+            # the files are not flushed
+            write_json_file(filename, messages, fsync='none')
+            self.written.add(key)
+
+    def close(self):
+        self.flush()
+
+
+def save_qutim_history(dst_dir, protocol, account, contact, messages,
+                       append=False):
+    if messages is None:
+        return
+
+    writer = HistoryWriter(dst_dir, protocol, account, contact, append)
+    for message in messages:
+        writer.add(message)
+    writer.close()
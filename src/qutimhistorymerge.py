@@ -17,11 +17,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import json
+import hashlib
 import argparse
+import collections
+from qutimhistory import get_accounts, get_json_files, load_json_file, \
+    print_plan, run_tasks, write_json_file
 
 
 def version():
-    return 'v0.1.0'
+    return 'v0.2.0'
 
 
 def description():
@@ -29,6 +33,23 @@ def description():
            'the qutIM before use this script.'
 
 
+MESSAGE_FIELDS = ("datetime", "in", "text")
+
+
+def dedupe_key(value):
+    # the argparse type of --dedupe-key, the unknown field would make
+    # the key None for all messages and drop them as the duplicates
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    if not fields:
+        raise argparse.ArgumentTypeError("the field list is empty")
+    for field in fields:
+        if field not in MESSAGE_FIELDS:
+            raise argparse.ArgumentTypeError(
+                "unknown field '%s' (allowed: %s)" %
+                (field, ",".join(MESSAGE_FIELDS)))
+    return fields
+
+
 def create_parser():
     parser = argparse.ArgumentParser(description=description())
     parser.add_argument('--version', action='version',
@@ -39,59 +60,187 @@ def create_parser():
                         help='the source qutIM directory')
     parser.add_argument('--dst', action='store', required=True,
                         help='the destination qutIM directory.')
+    parser.add_argument('--dedupe-key', action='store', type=dedupe_key,
+                        default='datetime,in,text',
+                        help='the comma separated list of the message '
+                             'fields which identify the message '
+                             '(default: %(default)s)')
+    parser.add_argument('--jobs', action='store', type=int,
+                        default=os.cpu_count() or 1,
+                        help='the number of the parallel jobs '
+                             '(default: %(default)s)')
+    parser.add_argument('--fsync', action='store',
+                        choices=['none', 'file', 'full'], default='file',
+                        help='flush the written files to the disk: none, '
+                             'file (the file data) or full (the file data '
+                             'and the directory entry) (default: %(default)s)')
+    parser.add_argument('--full', action='store_true',
+                        help='merge all source files, even if they are not '
+                             'changed since the last merge')
+    parser.add_argument('--plan', action='store_true',
+                        help='do not merge, only print the number of files '
+                             'which would be copied, merged or skipped and '
+                             'the estimated time')
     return parser.parse_args()
 
 
-def get_icq_accounts(src_dir):
-    return [uin
-            for uin in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, uin)) and
-            uin.startswith("icq")]
+def read_json_file(filename):
+    # returns the data and the manifest record of the file
+    with open(filename, 'rb') as data_file:
+        stat = os.fstat(data_file.fileno())
+        raw = data_file.read()
+    return json.loads(raw.decode('utf8')), {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha1": hashlib.sha1(raw).hexdigest()
+    }
+
+
+def manifest_filename(dst_dir):
+    return os.path.join(dst_dir, "qutimhistorymerge.manifest.json")
+
+
+def load_manifest(dst_dir):
+    filename = manifest_filename(dst_dir)
+    if not os.path.exists(filename):
+        return {}
+    return load_json_file(filename)
+
+
+def save_manifest(dst_dir, manifest, fsync):
+    os.makedirs(dst_dir, exist_ok=True)
+    write_json_file(manifest_filename(dst_dir), manifest, fsync)
+
+
+def is_same_stat(filename, size, mtime):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == size and stat.st_mtime_ns == mtime
+
+
+def is_dst_unchanged(dst_json_file, record):
+    # the destination may be changed or restored after the merge,
+    # the manifests of the older versions do not record it
+    return "dst_size" in record and \
+        is_same_stat(dst_json_file, record["dst_size"], record["dst_mtime"])
 
 
-def get_jabber_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("jabber")]
+def is_unchanged(src_json_file, dst_json_file, record):
+    if record is None:
+        return False
+    return is_same_stat(src_json_file, record["size"], record["mtime"]) and \
+        is_dst_unchanged(dst_json_file, record)
 
 
-def get_skype_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("skype")]
+def set_dst_stat(record, dst_json_file):
+    # records the destination file after the merge
+    stat = os.stat(dst_json_file)
+    record["dst_size"] = stat.st_size
+    record["dst_mtime"] = stat.st_mtime_ns
+    return record
 
 
-def get_vk_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("vk")]
+def message_key(message, fields):
+    return tuple(message.get(field) for field in fields)
 
 
-def get_sms_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("sms")]
+def merge_messages(dst_messages, src_messages, fields):
+    messages = list(dst_messages)
+    index = set(message_key(item, fields) for item in messages)
+    for item in src_messages:
+        key = message_key(item, fields)
+        if key not in index:
+            index.add(key)
+            messages.append(item)
 
+    messages.sort(key=lambda x: x['datetime'])
 
-def get_json_files(dir):
-    return [name
-            for name in os.listdir(dir)
-            if os.path.isfile(os.path.join(dir, name)) and
-            name.endswith(".json")]
+    return messages
 
 
-def load_json_file(filename):
-    with open(filename) as data_file:
-        return json.load(data_file)
+def merge_json_file(src_json_file, dst_json_file, fields, fsync,
+                    old_record=None):
+    # old_record is the manifest record of the previous merge
+    src_data, record = read_json_file(src_json_file)
+    if os.path.exists(dst_json_file):
+        if old_record is not None and \
+                record["sha1"] == old_record["sha1"] and \
+                is_dst_unchanged(dst_json_file, old_record):
+            result = ("SKIP:", src_json_file, "==", dst_json_file)
+        else:
+            messages = merge_messages(load_json_file(dst_json_file),
+                                      src_data,
+                                      fields)
+            if write_json_file(dst_json_file, messages, fsync):
+                result = ("MERGE:", src_json_file, "<>", dst_json_file)
+            else:
+                result = ("UNCHANGED:", src_json_file, "==", dst_json_file)
+    else:
+        write_json_file(dst_json_file, src_data, fsync)
+        result = ("COPY:", src_json_file, ">>", dst_json_file)
+    return result, set_dst_stat(record, dst_json_file)
+
+
+def skip_json_file(src_json_file, dst_json_file):
+    return ("SKIP:", src_json_file, "==", dst_json_file), None
+
 
+def get_merge_action(src_json_file, dst_json_file, sources, full):
+    if not os.path.exists(dst_json_file):
+        return "COPY", None
+    record = None
+    if not full:
+        record = sources.get(os.path.abspath(src_json_file))
+    if record is None:
+        return "MERGE", None
+    if is_unchanged(src_json_file, dst_json_file, record):
+        return "SKIP", record
+    return "MERGE", record
 
-def write_json_file(filename, data):
-    with open(filename, 'w', encoding='utf8') as outfile:
-        json.dump(data, outfile, sort_keys=True, indent=1, ensure_ascii=False)
+
+def get_json_file_pairs(src_dir, dst_dir, accounts):
+    for account in accounts:
+        src_prefix = os.path.join(src_dir, "history", account)
+        dst_prefix = os.path.join(dst_dir, "history", account)
+        for json_file in get_json_files(src_prefix):
+            yield (os.path.join(src_prefix, json_file),
+                   os.path.join(dst_prefix, json_file))
+
+
+def get_merge_tasks(src_dir, dst_dir, accounts, fields, fsync,
+                    sources, full):
+    for src_json_file, dst_json_file in \
+            get_json_file_pairs(src_dir, dst_dir, accounts):
+        os.makedirs(os.path.dirname(dst_json_file), exist_ok=True)
+        action, record = get_merge_action(src_json_file, dst_json_file,
+                                          sources, full)
+        if action == "SKIP":
+            yield skip_json_file, (src_json_file, dst_json_file)
+        elif record is not None:
+            yield merge_json_file, (src_json_file, dst_json_file,
+                                    fields, fsync, record)
+        else:
+            yield merge_json_file, (src_json_file, dst_json_file,
+                                    fields, fsync)
+
+
+def plan_merge(src_dir, dst_dir, accounts, sources, full):
+    plan = collections.OrderedDict(
+        [("COPY", [0, 0]), ("MERGE", [0, 0]), ("SKIP", [0, 0])])
+    for src_json_file, dst_json_file in \
+            get_json_file_pairs(src_dir, dst_dir, accounts):
+        action, record = get_merge_action(src_json_file, dst_json_file,
+                                          sources, full)
+        plan[action][0] += 1
+        if action == "COPY":
+            plan[action][1] += os.path.getsize(src_json_file)
+        elif action == "MERGE":
+            plan[action][1] += os.path.getsize(src_json_file) + \
+                os.path.getsize(dst_json_file)
+
+    return plan
 
 
 def main():
@@ -100,44 +249,38 @@ def main():
     src_dir = parser.src
     dst_dir = parser.dst
     verbose = parser.verbose
+    jobs = parser.jobs
+    full = parser.full
+    fsync = parser.fsync
+    plan = parser.plan
+    dedupe_fields = parser.dedupe_key
 
     print("Summary:")
     print("|  Input Directory:", src_dir)
     print("| Output Directory:", dst_dir)
-
-    accounts = []
-    accounts.extend(get_icq_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_jabber_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_skype_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_vk_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_sms_accounts(os.path.join(src_dir, "history")))
-
-    for account in accounts:
-        src_prefix = os.path.join(src_dir, "history", account)
-        dst_prefix = os.path.join(dst_dir, "history", account)
-        os.makedirs(dst_prefix, exist_ok=True)
-        json_files = get_json_files(src_prefix)
-        for json_file in json_files:
-            src_json_file = os.path.join(src_prefix, json_file)
-            dst_json_file = os.path.join(dst_prefix, json_file)
-            if os.path.exists(dst_json_file):
-                if verbose:
-                    print("MERGE:", src_json_file, "<>", dst_json_file)
-
-                messages = []
-                messages.extend(load_json_file(dst_json_file))
-                for item in load_json_file(src_json_file):
-                    if not item in messages:
-                        messages.append(item)
-
-                messages.sort(key=lambda x: x['datetime'])
-
-                write_json_file(dst_json_file, messages)
-            else:
-                if verbose:
-                    print("COPY:", src_json_file, ">>", dst_json_file)
-                data = load_json_file(src_json_file)
-                write_json_file(dst_json_file, data)
+    print("|       Dedupe Key:", ",".join(dedupe_fields))
+    print("|             Jobs:", jobs)
+    print("|       Full Merge:", full)
+    print("|            Fsync:", fsync)
+
+    accounts = get_accounts(os.path.join(src_dir, "history"))
+
+    manifest = load_manifest(dst_dir)
+    sources = manifest.setdefault("sources", {})
+    if plan:
+        print_plan(plan_merge(src_dir, dst_dir, accounts, sources, full),
+                   jobs)
+        return
+
+    tasks = get_merge_tasks(src_dir, dst_dir, accounts, dedupe_fields,
+                            fsync, sources, full)
+    for result, record in run_tasks(tasks, jobs):
+        if verbose:
+            print(*result)
+        if record is not None:
+            sources[os.path.abspath(result[1])] = record
+
+    save_manifest(dst_dir, manifest, fsync)
 
 
 if __name__ == "__main__":
@@ -16,12 +16,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
-import json
 import argparse
+import collections
+from qutimhistory import get_accounts, get_json_files, load_json_file, \
+    print_plan, run_tasks, write_json_file
 
 
 def version():
-    return 'v0.1.0'
+    return 'v0.2.0'
 
 
 def description():
@@ -37,59 +39,72 @@ def create_parser():
                         help='print various debugging information')
     parser.add_argument('--src', action='store', required=True,
                         help='the qutIM directory')
+    parser.add_argument('--jobs', action='store', type=int,
+                        default=os.cpu_count() or 1,
+                        help='the number of the parallel jobs '
+                             '(default: %(default)s)')
+    parser.add_argument('--fsync', action='store',
+                        choices=['none', 'file', 'full'], default='file',
+                        help='flush the written files to the disk: none, '
+                             'file (the file data) or full (the file data '
+                             'and the directory entry) (default: %(default)s)')
+    parser.add_argument('--plan', action='store_true',
+                        help='do not sort, only print the number of files '
+                             'which would be checked and the estimated time')
     return parser.parse_args()
 
 
-def get_icq_accounts(src_dir):
-    return [uin
-            for uin in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, uin)) and
-            uin.startswith("icq")]
+def is_sorted(messages):
+    return all(messages[i]['datetime'] <= messages[i + 1]['datetime']
+               for i in range(len(messages) - 1))
 
 
-def get_jabber_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("jabber")]
+def sort_messages(messages):
+    # list.sort() is stable, the messages with the same datetime
+    # keep their order from the file
+    messages.sort(key=lambda x: x['datetime'])
+    return messages
 
 
-def get_skype_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("skype")]
+def sort_json_file(filename, fsync):
+    # returns False if the file is already sorted, such file
+    # is not encoded and compared at all
+    messages = load_json_file(filename)
+    if is_sorted(messages):
+        return False
 
+    return write_json_file(filename, sort_messages(messages), fsync)
 
-def get_vk_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("vk")]
 
+def sort_json_file_task(filename, fsync):
+    if sort_json_file(filename, fsync):
+        return "SORTING:", filename
+    return "SKIP:", filename
 
-def get_sms_accounts(src_dir):
-    return [jid
-            for jid in os.listdir(src_dir)
-            if os.path.isdir(os.path.join(src_dir, jid)) and
-            jid.startswith("sms")]
-
-
-def get_json_files(dir):
-    return [name
-            for name in os.listdir(dir)
-            if os.path.isfile(os.path.join(dir, name)) and
-            name.endswith(".json")]
-
-
-def load_json_file(filename):
-    with open(filename) as data_file:
-        return json.load(data_file)
 
+def get_sort_tasks(src_dir, accounts, fsync):
+    for account in accounts:
+        src_prefix = os.path.join(src_dir, "history", account)
+        # the files are replaced while sorting, so the directory
+        # is listed before the first file is processed
+        for json_file in sorted(get_json_files(src_prefix)):
+            yield sort_json_file_task, (os.path.join(src_prefix, json_file),
+                                        fsync)
+
+
+def plan_sort(src_dir, accounts):
+    # the files can not be classified without parsing, so every file
+    # is counted as checked; the sorted and unchanged ones are not
+    # rewritten by the real run
+    plan = collections.OrderedDict([("CHECK", [0, 0])])
+    for account in accounts:
+        src_prefix = os.path.join(src_dir, "history", account)
+        for json_file in get_json_files(src_prefix):
+            plan["CHECK"][0] += 1
+            plan["CHECK"][1] += os.path.getsize(
+                os.path.join(src_prefix, json_file))
 
-def write_json_file(filename, data):
-    with open(filename, 'w', encoding='utf8') as outfile:
-        json.dump(data, outfile, sort_keys=True, indent=1, ensure_ascii=False)
+    return plan
 
 
 def main():
@@ -97,26 +112,26 @@ def main():
 
     src_dir = parser.src
     verbose = parser.verbose
+    jobs = parser.jobs
+    fsync = parser.fsync
+    plan = parser.plan
 
     print("Summary:")
     print("| qutIM directory:", src_dir)
+    print("|            Jobs:", jobs)
+    print("|           Fsync:", fsync)
 
-    accounts = []
-    accounts.extend(get_icq_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_jabber_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_skype_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_vk_accounts(os.path.join(src_dir, "history")))
-    accounts.extend(get_sms_accounts(os.path.join(src_dir, "history")))
+    accounts = get_accounts(os.path.join(src_dir, "history"))
+
+    if plan:
+        print_plan(plan_sort(src_dir, accounts), jobs)
+        return
+
+    tasks = get_sort_tasks(src_dir, accounts, fsync)
+    for result in run_tasks(tasks, jobs):
+        if verbose:
+            print(*result)
 
-    for account in accounts:
-        src_prefix = os.path.join(src_dir, "history", account)
-        json_files = get_json_files(src_prefix)
-        for json_file in json_files:
-            if verbose:
-                print("SORTING:", json_file)
-            src_json_file = os.path.join(src_prefix, json_file)
-            data = load_json_file(src_json_file)
-            write_json_file(src_json_file, data)
 
 if __name__ == "__main__":
     main()
@@ -15,11 +15,10 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-import os
-import json
 import datetime
 import argparse
 import sqlite3
+from qutimhistory import jid_escaped, save_qutim_history
 
 
 def version():
@@ -159,32 +158,11 @@ def read_database(filename, sid, verbose=False):
     return contacts, messages
 
 
-def jid_escaped(jid):
-    return jid.replace("@", "%0040").replace("_", "%005f").replace("-", "%002d")
-
-
 def save_qutim_skype_history(dst_dir, sid, contact, messages, verbose=False):
     # format:
     #   history/skype.account/user.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "skype." + jid_escaped(sid))
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, jid_escaped(contact) + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
+    save_qutim_history(dst_dir, "skype", jid_escaped(sid),
+                       jid_escaped(contact), messages)
 
 
 def main():
@@ -16,11 +16,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
-import json
+import re
 import datetime
 import argparse
 import csv
 from xml.dom import minidom
+from xml.etree import ElementTree
+from qutimhistory import child_nodes_to_text, jid_escaped, run_tasks, \
+    save_qutim_history
 
 
 def version():
@@ -28,7 +31,7 @@ def version():
 
 
 def description():
-    return 'This utility convert sms xml file to the ' \
+    return 'This utility convert the sms backup files to the ' \
            'qutIM message history. Please, do not use '                 \
            'the qutIM working copy as the output directory. '           \
            'It may damage the your message history. Just select '       \
@@ -43,8 +46,14 @@ def create_parser():
                         help='print various debugging information')
     parser.add_argument('--phone', action='store', default=None,
                         help='your phone')
-    parser.add_argument('--src', action='store', required=True,
-                        help='sms xml file')
+    parser.add_argument('--src', action='store', required=True, nargs='+',
+                        help='sms backup files of any supported format, '
+                             'the messages repeated in the overlapping '
+                             'backups are saved once')
+    parser.add_argument('--jobs', action='store', type=int,
+                        default=os.cpu_count() or 1,
+                        help='the number of the files parsed in parallel '
+                             '(default: %(default)s)')
     parser.add_argument('--dst', action='store', required=True,
                         help='the output directory. '
                              'WARNING: do not use the qutIM working copy '
@@ -68,37 +77,18 @@ def get_messages(messages, contact, verbose=False):
     return objects
 
 
-def jid_escaped(jid):
-    return jid.replace("@", "%0040").replace("_", "%005f").replace("-", "%002d")
-
-
 def save_qutim_sms_history(dst_dir, phone, contact, messages, verbose=False):
     # format:
     #   history/sms.phone/user.201409.json
-    if messages is None:
-        return
-
-    ym_hash = {}
-    for message in messages:
-        key = message['datetime'][0:4] + message['datetime'][5:7]
-        if key not in ym_hash:
-            ym_hash[key] = []
-        ym_hash[key].append(message)
-
-    path = os.path.join(dst_dir, "history", "sms." + jid_escaped(phone))
-    os.makedirs(path, exist_ok=True)
-
-    for key in ym_hash:
-        filename = os.path.join(path, jid_escaped(contact) + "." + key + ".json")
-        f = open(filename, 'w', encoding='utf8')
-        f.write(json.dumps(ym_hash[key],
-                           sort_keys=True, indent=1, ensure_ascii=False))
-        f.close()
+    save_qutim_history(dst_dir, "sms", jid_escaped(phone),
+                       jid_escaped(contact), messages)
 
 
 def read_sms_file_1(filename):
-    records = []
-    for line in open(filename, 'r').readlines():
+    # the semicolon line format:
+    #   dd.mm.yy HH:MM:SS;'phone';name;text
+    data_file = open(filename, 'r')
+    for line in data_file:
         parts = line.split(";")
         date = parts[0].replace(".04 ", ".2004 ").replace(".05 ", ".2005 ").replace(".06 ", ".2006 ").replace(".07 ", ".2007 ").replace(".08 ", ".2008 ").replace(".09 ", ".2009 ")
         try:
@@ -108,14 +98,14 @@ def read_sms_file_1(filename):
         phone = parts[1].replace("'", "").replace("+", "")
         name = parts[2]
         msg = parts[3]
-        records.append({
+        yield {
             "datetime": date,
             "phone": phone.strip(),
             "name": name.strip(),
             "text": msg.strip(),
             "incomming": True
-        })
-    return records
+        }
+    data_file.close()
 
 
 def split_name_phone(data):
@@ -127,7 +117,8 @@ def split_name_phone(data):
 
 
 def read_sms_file_2(filename):
-    records = []
+    # the csv format:
+    #   name [phone];name [phone];text;yyyy.mm.dd
     csvfile = open(filename, 'r', encoding="utf-8")
     csvreader = csv.reader(csvfile, delimiter=';')
     n = 0
@@ -145,98 +136,206 @@ def read_sms_file_2(filename):
             incomming = False
             phone, name = split_name_phone(contact_to)
 
-        records.append({
+        yield {
            "datetime": date,
            "phone": phone.strip(),
            "name": name.strip(),
            "text": text.strip(),
            "incomming": incomming
-        })
-    return records
+        }
+    csvfile.close()
 
 
-def node_to_text(node, name):
-    if len(node.getElementsByTagName(name)) == 0:
-        return None
-    x = node.getElementsByTagName(name)[0].firstChild
-    if x is None:
-        return None
-    return x.nodeValue
+SMS_FIELDS = ("from", "to", "timestamp", "body")
 
 
 def read_sms_file_3(filename):
-    records = []
+    # the <mpe_messages> xml format
     xmldoc = minidom.parse(filename)
     for imhistory in xmldoc.getElementsByTagName('mpe_messages'):
         for event in imhistory.getElementsByTagName('sms'):
-            contact_from = node_to_text(event, "from")
+            fields = child_nodes_to_text(event, SMS_FIELDS)
+            contact_from = fields["from"]
             if contact_from is not None:
                 contact_from = contact_from.replace("+", "").replace(" ", "").replace(">", "").replace("<", "").strip()
                 phone = contact_from
-            contact_to = node_to_text(event, "to")
+            contact_to = fields["to"]
             if contact_to is not None:
                 contact_to = contact_to.replace("+", "").replace(" ", "").replace(">", "").replace("<", "").strip()
                 phone = contact_to
-            date = node_to_text(event, "timestamp")
-            body = node_to_text(event, "body")
+            date = fields["timestamp"]
+            body = fields["body"]
             if body is not None:
                 body = body.strip()
             date = datetime.datetime.strptime(date, "%d.%m.%Y %H:%M:%S")
             incomming = contact_from is not None
-            records.append({
+            yield {
                 "datetime": date,
                 "phone": phone.strip(),
                 "name": "",
                 "text": body,
                 "incomming": incomming
-            })
-
-    return records
+            }
 
 
 def read_sms_file_4(filename):
-    records = []
-    xmldoc = minidom.parse(filename)
-    for imhistory in xmldoc.getElementsByTagName('smses'):
-        for event in imhistory.getElementsByTagName('sms'):
-            phone = event.attributes["address"].value.replace("+", "").replace(" ", "").replace(">", "").replace("<", "").strip()
-            date = datetime.datetime.fromtimestamp(int(event.attributes["date"].value)/1000)
-            incomming = event.attributes["type"].value == "1"
-            text = event.attributes["body"].value.strip()
-            records.append({
+    # yields the records of the <sms> elements inside <smses> one by one,
+    # the parsed elements are cleared at once, so the memory does not
+    # depend on the file size
+    depth = 0
+    smses = 0
+    root = None
+    for action, elem in ElementTree.iterparse(filename,
+                                              events=("start", "end")):
+        if action == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            if elem.tag == "smses":
+                smses += 1
+            continue
+
+        depth -= 1
+        if elem.tag == "smses":
+            smses -= 1
+        elif elem.tag == "sms" and smses > 0:
+            phone = elem.attrib["address"].replace("+", "").replace(" ", "").replace(">", "").replace("<", "").strip()
+            date = datetime.datetime.fromtimestamp(int(elem.attrib["date"])/1000)
+            incomming = elem.attrib["type"] == "1"
+            text = elem.attrib["body"].strip()
+            yield {
                 "datetime": date,
                 "phone": phone,
                 "name": "",
                 "text": text,
                 "incomming": incomming
-            })
+            }
+
+        # the top level elements (with the mms data) are dropped
+        # when they are complete
+        if depth == 1:
+            root.clear()
+
+
+SMS_READERS = {
+    1: read_sms_file_1,
+    2: read_sms_file_2,
+    3: read_sms_file_3,
+    4: read_sms_file_4
+}
+
+SNIFF_SIZE = 4096
+XML_IGNORED = re.compile(r'<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>', re.DOTALL)
+XML_ROOT = re.compile(r'<([A-Za-z_][^\s/>]*)')
+LINE_DATE = re.compile(r'^\d{1,2}\.\d{1,2}\.\d{2}(\d{2})? \d{1,2}:\d{2}')
+CSV_DATE = re.compile(r'^\d{4}\.\d{1,2}\.\d{1,2}$')
+
+
+def detect_sms_format(filename):
+    # returns the number of the reader, only the head of the file is read:
+    #   <smses>        - 4, SMS Backup & Restore xml
+    #   <mpe_messages> - 3, the mpe xml
+    #   the csv rows with the date in the 4th column - 2
+    #   the semicolon lines with the date in the 1st field - 1
+    with open(filename, 'rb') as data_file:
+        head = data_file.read(SNIFF_SIZE).decode('utf-8', 'replace')
+    head = head.lstrip('\ufeff \t\r\n')
+
+    if head.startswith('<'):
+        match = XML_ROOT.search(XML_IGNORED.sub('', head))
+        if match is not None:
+            if match.group(1) == 'smses':
+                return 4
+            if match.group(1) == 'mpe_messages':
+                return 3
+        raise ValueError("%s: unknown sms xml root element" % filename)
+
+    # the last line may be incomplete
+    lines = head.splitlines()[:-1] or head.splitlines()
+    for line in lines:
+        if not line.strip():
+            continue
+        if LINE_DATE.match(line) and len(line.split(";")) >= 4:
+            return 1
+        row = next(csv.reader([line], delimiter=';'))
+        if len(row) >= 4 and CSV_DATE.match(row[3]):
+            return 2
+        break
+    raise ValueError("%s: unknown sms file format" % filename)
+
+
+def read_sms_records(filename, sms_format):
+    return list(SMS_READERS[sms_format](filename))
+
+
+def read_sms_files(sources, jobs):
+    # sources: the list of (filename, format),
+    # yields the records of the files in the order of the files
+    if jobs <= 1 or len(sources) <= 1:
+        for filename, sms_format in sources:
+            yield from SMS_READERS[sms_format](filename)
+        return
+
+    tasks = ((read_sms_records, source) for source in sources)
+    for records in run_tasks(tasks, jobs):
+        yield from records
+
 
-    return records
+def record_key(rec):
+    return rec["phone"], rec["datetime"], rec["incomming"], rec["text"]
+
+
+def dedupe_records(records, counter):
+    # skips the records which are already seen, counter[0] is
+    # the number of the skipped records
+    keys = set()
+    for rec in records:
+        key = record_key(rec)
+        if key in keys:
+            counter[0] += 1
+            continue
+        keys.add(key)
+        yield rec
+
+
+def group_by_contact(records):
+    # the records of every phone in the order of the file,
+    # the contacts are ordered by their first record
+    messages = {}
+    for rec in records:
+        if rec["phone"] not in messages:
+            messages[rec["phone"]] = []
+        messages[rec["phone"]].append(rec)
+
+    return messages
 
 
 def main():
     parser = create_parser()
 
     phone = parser.phone
-    src_file = parser.src
+    src_files = parser.src
+    jobs = parser.jobs
     dst_dir = parser.dst
     verbose = parser.verbose
 
     print("Summary:")
     print("|         PHONE ID:", phone)
-    print("|     SMS XML File:", src_file)
+    print("|        SMS Files:", ", ".join(src_files))
     print("| Output Directory:", dst_dir)
+    print("|             Jobs:", jobs)
     print("|          Verbose:", verbose)
 
-    records = read_sms_file_4(src_file)
-    contacts = list(set([rec["phone"] for rec in records]))
-    messages = {}
-    for contact in contacts:
-        for rec in records:
-            if contact == rec["phone"]:
-                if contact not in messages:
-                    messages[contact] = []
-                messages[contact].append(rec)
+    sources = [(filename, detect_sms_format(filename))
+               for filename in src_files]
+    for filename, sms_format in sources:
+        print("FORMAT:", sms_format, filename)
+
+    duplicates = [0]
+    messages = group_by_contact(
+        dedupe_records(read_sms_files(sources, jobs), duplicates))
+    contacts = list(messages)
+    print("DUPLICATES:", duplicates[0])
 
     if verbose:
         print("CONTACTS:", contacts)